@@ -1,5 +1,10 @@
 import os
+import re
+import sys
+import atexit
+import logging
 import argparse
+from itertools import chain
 from typing import Callable, Any
 
 # =========================================================
@@ -11,31 +16,33 @@ VERIFY_HANDLERS: dict[str, Callable[[str], dict[str, Any]]] = {}
 STATE_HANDLERS: dict[str, Callable[[str], dict[str, Any]]] = {}
 NVIDIA_GPUS_PATH = "/proc/driver/nvidia/gpus/"
 BATTS_PATH = "/sys/class/power_supply/"
+PCI_DEVICES_PATH = "/sys/bus/pci/devices/"
+_log = logging.getLogger(__name__)
+_FD_CACHE: dict[str, int] = {}
+_DIR_FD_CACHE: dict[str, int] = {}
+_ACPI_FLAGS = ("_PR0", "_PR3")
 
 
 SYS_FILES = {
     "chassis": {
-        "path": "/sys/class/dmi/id/chassis_type",
-        "mode": 'r'
+        "path": "/sys/class/dmi/id/chassis_type"
     },
     "acpi": {
-        "path": "/sys/firmware/acpi/tables/DSDT", "mode": 'rb'
+        "path": "/sys/firmware/acpi/tables/DSDT"
     },
     "kernel": {
-        "path": "/proc/version",
-        "mode": 'r'
+        "path": "/proc/version"
     },
     "s3": {
-        "path": "/sys/power/mem_sleep",
-        "mode": 'r'
+        "path": "/sys/power/mem_sleep"
     }
 }
 
 
 NVIDIA_STATE = {
-    "rtd3_status": "/proc/driver/nvidia/gpus/{}/power",
-    "power_state": "/sys/bus/pci/devices/{}/power_state",
-    "runtime_status": "/sys/bus/pci/devices/{}/power/runtime_status"
+    "rtd3_status": NVIDIA_GPUS_PATH + "{}/power",
+    "power_state": PCI_DEVICES_PATH + "{}/power_state",
+    "runtime_status": PCI_DEVICES_PATH + "{}/power/runtime_status"
 }
 
 
@@ -65,18 +72,58 @@ NVIDIA_FILES = {
 }
 
 
+_SEARCH_DIRS = (".", os.path.dirname(os.path.abspath(__file__)))
+
+# Derived from the tables above, filled in by _specialize()
+_ACPI_RE: re.Pattern[bytes]
+_INSTALL_PATHS: dict[str, str]
+_VERIFY_PLAN: tuple[tuple[str, str, Callable[[str], str], Callable[[str], dict[str, Any]]], ...]
+_NVIDIA_STATE_ITEMS: tuple[tuple[str, str], ...]
+_BATTS_STATE_ITEMS: tuple[tuple[str, str], ...]
+
+
 # =========================================================
 # Section: Basic operations
 # =========================================================
 
 
+def _find_file(name: str, dirs: tuple[str, ...] = _SEARCH_DIRS) -> str:
+    for directory in dirs:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return path
+    _log.debug("Could not find %s in %s", name, dirs)
+    return name
+
+
 def _create_file(file: str):
     print(f"Creating {file}")
-    src = NVIDIA_FILES[file]["src"]
-    dst = NVIDIA_FILES[file]["dst"]
-    with open(src, 'r') as f:
-        with open(os.path.join(dst, src), 'w') as dst_f:
-            dst_f.write(f.read())
+    src = _find_file(NVIDIA_FILES[file]["src"])
+    dst = _INSTALL_PATHS[file]
+    tmp = dst + ".tmp"
+    parent = os.path.dirname(dst)
+    os.makedirs(parent, exist_ok=True)
+    with open(src, 'rb') as f:
+        data = memoryview(f.read())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    # Keep the first backup: it holds the user's original, not a file we installed
+    bak = dst + ".bak"
+    try:
+        os.link(dst, bak)
+        print(f"Backed up {dst} to {bak}")
+    except (FileNotFoundError, FileExistsError):
+        pass
+    os.replace(tmp, dst)
     print(f"Created {file}")
 
 
@@ -86,11 +133,83 @@ def _delete_file(path: str):
     print(f"Deleted: {path}")
 
 
-def _read_file(path: str, mode: str = 'r') -> str:
-    data = ""
-    with open(path, mode) as f:
-        data = f.read().decode(errors="ignore") if mode == "rb" else f.read()
-    return data
+def _log_read_error(path: str, e: OSError) -> None:
+    # Missing nodes are expected on some hardware, lacking root is not
+    level = logging.WARNING if isinstance(e, PermissionError) else logging.DEBUG
+    _log.log(level, "Could not read %s: %s", path, e)
+
+
+def _read_bytes(path: str) -> bytes:
+    chunks = []
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        _log_read_error(path, e)
+        return b""
+    try:
+        while chunk := os.read(fd, 65536):
+            chunks.append(chunk)
+    except OSError as e:
+        _log_read_error(path, e)
+        return b""
+    finally:
+        os.close(fd)
+    return b"".join(chunks)
+
+
+def _read_file(path: str) -> str:
+    return _read_bytes(path).decode(errors="ignore")
+
+
+def _open_in_dir(path: str) -> int:
+    for root in (NVIDIA_GPUS_PATH, PCI_DEVICES_PATH):
+        if path.startswith(root):
+            dir_fd = _DIR_FD_CACHE.get(root)
+            if dir_fd is None:
+                dir_fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+                _DIR_FD_CACHE[root] = dir_fd
+            return os.open(path[len(root):], os.O_RDONLY, dir_fd=dir_fd)
+    return os.open(path, os.O_RDONLY)
+
+
+def _read_file_cached(path: str) -> str:
+    fd = _FD_CACHE.get(path)
+    try:
+        if fd is None:
+            fd = _open_in_dir(path)
+            _FD_CACHE[path] = fd
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, 4096).decode(errors="ignore")
+    except OSError as e:
+        _log_read_error(path, e)
+        return ""
+
+
+def _read_dsdt_flags(path: str) -> str:
+    seen = set()
+    for match in _ACPI_RE.finditer(_read_bytes(path)):
+        seen.add(match.group().decode())
+        if len(seen) == len(_ACPI_FLAGS):
+            break
+    return "".join(flag for flag in _ACPI_FLAGS if flag in seen)
+
+
+def _scan_prefix(path: str, prefix: str = "") -> list[str]:
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.name.startswith(prefix)]
+    except OSError as e:
+        _log_read_error(path, e)
+        return []
+
+
+@atexit.register
+def _close_cached_files():
+    for cache in (_FD_CACHE, _DIR_FD_CACHE):
+        for fd in cache.values():
+            os.close(fd)
+        cache.clear()
 
 
 # =========================================================
@@ -109,17 +228,25 @@ def handler(dict_handler: dict[str, Callable[[str], dict[str, Any]]], name: str)
 # =========================================================
 
 
+def _parse_version(version_str: str) -> tuple[int, int]:
+    version_parts = version_str.split('.')
+    if len(version_parts) < 2:
+        return -1, -1
+    try:
+        first = int(version_parts[0])
+        # Minor part may carry a suffix, e.g. "6.1-rc5" or "6.1+"
+        digits = len(version_parts[1]) - len(version_parts[1].lstrip("0123456789"))
+        second = int(version_parts[1][:digits])
+    except ValueError:
+        return -1, -1
+    return first, second
+
+
 @handler(VERIFY_HANDLERS, "kernel")
 def kernel_handler(data: str) -> dict[str, Any]:
     parts = data.split()
     version_str = parts[2] if len(parts) > 2 else "Unknown"
-    version_parts = version_str.split('.')
-    first, second = -1, -1
-    try:
-        if len(version_parts) >= 2:
-            first, second = map(int, version_parts[:2])
-    except ValueError:
-        first, second = -1, -1
+    first, second = _parse_version(version_str)
     supported = (first, second) >= (4, 18)
     return {
         "value": f"{first}.{second}",
@@ -129,12 +256,8 @@ def kernel_handler(data: str) -> dict[str, Any]:
 
 @handler(VERIFY_HANDLERS, "acpi")
 def acpi_handler(data: str) -> dict[str, Any]:
-    flags = ["_PR0", "_PR3"]
-    value = ""
-    for flag in flags:
-        if flag in data:
-            value += flag
-    supported = "_PR0" in value and "_PR3" in value
+    value = "".join(flag for flag in _ACPI_FLAGS if flag in data)
+    supported = all(flag in value for flag in _ACPI_FLAGS)
     return {
         "value": value,
         "supported": str(supported)
@@ -161,9 +284,10 @@ def s3_handler(data: str) -> dict[str, Any]:
 
 @handler(STATE_HANDLERS, "rtd3_status")
 def rtd3_handler(data: str) -> dict[str, Any]:
-    temp = data.splitlines()
-    temp = temp[0].split(':') if len(temp) > 1 else temp
-    value = temp[1].strip() if len(temp) > 1 else "Unknown"
+    first_line = data.partition("\n")[0]
+    value = "Unknown"
+    if first_line.startswith("Runtime D3 status"):
+        value = first_line.partition(":")[2].strip() or value
     return {"value": value}
 
 
@@ -177,26 +301,22 @@ def runtime_status_handler(data: str) -> dict[str, Any]:
     return {"value": data.strip()}
 
 
-@handler(STATE_HANDLERS, "power_now")
-def power_now_handler(data: str) -> dict[str, Any]:
-    value = -1
+def _from_micro(data: str) -> float:
     try:
-        value = int(data.strip())
-        value *= (10**-6)
+        return int(data.strip()) * 1e-6
     except ValueError as e:
-        print(str(e))
-    return {"value": value}
+        _log.debug("Could not parse %r: %s", data, e)
+    return -1.0
+
+
+@handler(STATE_HANDLERS, "power_now")
+def power_now_handler(data: str) -> dict[str, Any]:
+    return {"value": _from_micro(data)}
 
 
 @handler(STATE_HANDLERS, "energy_now")
 def energy_now_handler(data: str) -> dict[str, Any]:
-    value = -1
-    try:
-        value = int(data.strip())
-        value *= (10**-6)
-    except ValueError as e:
-        print(str(e))
-    return {"value": value}
+    return {"value": _from_micro(data)}
 
 
 @handler(STATE_HANDLERS, "pci_info")
@@ -219,17 +339,28 @@ def pci_handler(data: str) -> dict[str, Any]:
 
 
 def _print_table(headers: list[str], rows: list[list[str]], margin: int = 2, name="Table") -> None:
-    col_width = max([len(str(val)) for val in headers] + [len(str(val))
-                    for row in rows for val in row]) + margin
+    col_width = max(len(str(val)) for val in chain(headers, *rows)) + margin
     table_width = col_width * len(headers)
-    print(name.center(table_width, '='))
-    header = "".join(f"{header:<{col_width}}" for header in headers)
-    print(header)
-    print('-' * table_width)
+    lines = [name.center(table_width, '=')]
+    lines.append("".join(str(header).ljust(col_width) for header in headers))
+    lines.append('-' * table_width)
     for row in rows:
-        row_str = "".join(f"{val:<{col_width}}" for val in row)
-        print(row_str)
-    print('=' * table_width)
+        lines.append("".join(str(val).ljust(col_width) for val in row))
+    lines.append('=' * table_width)
+    sys.stdout.write("\n".join(lines) + "\n")
+
+
+def _specialize() -> None:
+    global _ACPI_RE, _INSTALL_PATHS, _VERIFY_PLAN, _NVIDIA_STATE_ITEMS, _BATTS_STATE_ITEMS
+    _ACPI_RE = re.compile(rb"_PR[03]")
+    _INSTALL_PATHS = {key: os.path.join(value["dst"], value["src"])
+                      for key, value in NVIDIA_FILES.items()}
+    _VERIFY_PLAN = tuple(
+        (key, value["path"], _read_dsdt_flags if key == "acpi" else _read_file, VERIFY_HANDLERS[key])
+        for key, value in SYS_FILES.items()
+    )
+    _NVIDIA_STATE_ITEMS = tuple(NVIDIA_STATE.items())
+    _BATTS_STATE_ITEMS = tuple(BATTS_STATE.items())
 
 
 # =========================================================
@@ -239,34 +370,36 @@ def _print_table(headers: list[str], rows: list[list[str]], margin: int = 2, nam
 
 def verify() -> dict:
     headers = ["Check", "Value", "Supported"]
-    rows = []
-    for key, value in SYS_FILES.items():
-        raw = _read_file(value["path"], value["mode"])
-        data = VERIFY_HANDLERS[key](raw)
-        rows.append([key]+[value for key, value in data.items()])
+    rows = [[key, *func(reader(path)).values()]
+            for key, path, reader, func in _VERIFY_PLAN]
     _print_table(headers, rows, name="Requirements")
 
 
 def state() -> dict:
     headers = ["key", "value"]
     rows = []
-    gpus_dirs = os.listdir(NVIDIA_GPUS_PATH)
-    for pci in gpus_dirs:
+    gpus = _scan_prefix(NVIDIA_GPUS_PATH)
+    batts = _scan_prefix(BATTS_PATH, "BAT")
+    if not gpus:
+        _log.warning("No GPUs found in %s, is the NVIDIA driver loaded?", NVIDIA_GPUS_PATH)
+    targets = [(pci, key, value.format(pci))
+               for pci in gpus for key, value in _NVIDIA_STATE_ITEMS]
+    targets += [(batt, key, value.format(batt))
+                for batt in batts for key, value in _BATTS_STATE_ITEMS]
+    results = {(device, key): _read_file_cached(path) for device, key, path in targets}
+    for pci in gpus:
         data = pci_handler(pci)
         for key, value in data.items():
             rows.append([key, value])
-        for key, value in NVIDIA_STATE.items():
-            raw = _read_file(value.format(pci))
-            data = STATE_HANDLERS[key](raw)
+        for key, _ in _NVIDIA_STATE_ITEMS:
+            data = STATE_HANDLERS[key](results[pci, key])
             rows.append([key]+[value for key, value in data.items()])
         rows.append(['-'*5, '-'*5])
-    batts = os.listdir(BATTS_PATH)
-    for batt in [batt for batt in batts if "BAT" in batt]:
+    for batt in batts:
         rows.append(["battery", batt])
         temp = []
-        for key, value in BATTS_STATE.items():
-            raw = _read_file(value.format(batt))
-            data = STATE_HANDLERS[key](raw)
+        for key, _ in _BATTS_STATE_ITEMS:
+            data = STATE_HANDLERS[key](results[batt, key])
             temp.append(data["value"])
             rows.append([key]+[value for key, value in data.items()])
         rows.append(["Remaining time", temp[1] /
@@ -288,10 +421,8 @@ def install() -> None:
 
 def uninstall() -> None:
     print("=== Uninstallation started ===")
-    udev_path = os.path.join(
-        NVIDIA_FILES["udev"]["dst"], NVIDIA_FILES["udev"]["src"])
-    modprobe_path = os.path.join(
-        NVIDIA_FILES["modprobe"]["dst"], NVIDIA_FILES["modprobe"]["src"])
+    udev_path = _INSTALL_PATHS["udev"]
+    modprobe_path = _INSTALL_PATHS["modprobe"]
     print(f"Deleting file: {udev_path}")
     _delete_file(udev_path)
     print("Udev file deleted successfully.")
@@ -318,12 +449,16 @@ def setup_args() -> argparse.ArgumentParser:
                         help="Installs required udev and modprobe files.")
     parser.add_argument("-u", "--uninstall", action="store_true",
                         help="Removes udev and modprobe files, restoring backups if available.")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="Print debug messages, e.g. files that could not be read.")
     return parser
 
 
 def main():
     parser = setup_args()
     args = parser.parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(levelname)s: %(message)s")
 
     if args.verify:
         verify()
@@ -337,5 +472,8 @@ def main():
         parser.print_help()
 
 
+_specialize()
+
+
 if __name__ == "__main__":
     main()